@@ -5,7 +5,6 @@ import random
 import time
 from distutils.util import strtobool
 
-import gymnasium as gym
 import numpy as np
 import torch
 import torch.nn as nn
@@ -14,8 +13,9 @@ import torch.optim as optim
 from torch.utils.tensorboard import SummaryWriter
 
 from utils.wrappers import MergeActionMaskWrapper, RecordEpisodeStatistics
-from pytag.utils.common import make_env
+from pytag.utils.common import make_vec_env
 from utils.networks import PPOLSTM
+from utils.ppo_utils import compute_gae, ppo_loss
 
 def parse_args():
     # fmt: off
@@ -50,8 +50,18 @@ def parse_args():
         help="the learning rate of the optimizer")
     parser.add_argument("--num-envs", type=int, default=1,
         help="the number of parallel game environments")
+    parser.add_argument("--async-envs", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
+        help="if toggled, the game environments are stepped in parallel worker processes when there are more than --sync-threshold of them")
+    parser.add_argument("--sync-threshold", type=int, default=2,
+        help="with at most this many game environments they are stepped in this process even with --async-envs, "
+             "a worker process and JVM per env costs more than it saves for so few (set to 0 to always use workers)")
+    parser.add_argument("--thread-envs", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the game environments are stepped concurrently by threads of this process (overrides --async-envs)")
     parser.add_argument("--num-steps", type=int, default=128,
         help="the number of steps to run in each environment per policy rollout")
+    parser.add_argument("--storage-dtype", type=str, choices=["float32", "float16", "bfloat16"], default="float32",
+        help="the dtype of the reward, done and value rollout storage, it is upcast to float32 on read "
+             "(observations stay float32, the update recomputes the log-probs from them and rounded observations would move the PPO ratio away from 1)")
     parser.add_argument("--anneal-lr", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
         help="Toggle learning rate annealing for policy and value networks")
     parser.add_argument("--gamma", type=float, default=0.99,
@@ -126,9 +136,7 @@ if __name__ == "__main__":
         device = torch.device('cpu')
 
     # env setup
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args.env_id, args.seed + i, args.opponent, args.n_players) for i in range(args.num_envs)]
-    )
+    envs = make_vec_env(args.env_id, [args.seed + i for i in range(args.num_envs)], args.opponent, args.n_players, args.num_envs, asynchronous=args.async_envs, sync_threshold=args.sync_threshold, threads=args.thread_envs)
     # envs = SyncVectorEnv([
     #     lambda: StrategoWrapper(gym.make(args.env_id))
     #     for i in range(args.num_envs)
@@ -142,21 +150,31 @@ if __name__ == "__main__":
     optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
 
     # ALGO Logic: Storage setup
-    obs = torch.zeros((args.num_steps, args.num_envs) + envs.single_observation_space.shape).to(device)
-    masks = torch.zeros((args.num_steps, args.num_envs, envs.single_action_space.n), dtype=torch.bool).to(device)
-    actions = torch.zeros((args.num_steps, args.num_envs) + envs.single_action_space.shape).to(device)
-    logprobs = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    rewards = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    dones = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    values = torch.zeros((args.num_steps, args.num_envs)).to(device)
+    storage_dtype = getattr(torch, args.storage_dtype)
+    obs = torch.zeros((args.num_steps, args.num_envs) + envs.single_observation_space.shape, device=device)
+    masks = torch.zeros((args.num_steps, args.num_envs, envs.single_action_space.n), dtype=torch.bool, device=device)
+    actions = torch.zeros((args.num_steps, args.num_envs) + envs.single_action_space.shape, dtype=torch.long, device=device)
+    logprobs = torch.zeros((args.num_steps, args.num_envs), device=device)
+    rewards = torch.zeros((args.num_steps, args.num_envs), dtype=storage_dtype, device=device)
+    dones = torch.zeros((args.num_steps, args.num_envs), dtype=storage_dtype, device=device)
+    values = torch.zeros((args.num_steps, args.num_envs), dtype=storage_dtype, device=device)
+    # host side staging buffers for the env outputs, pinned on GPU runs so the copies to the device are asynchronous
+    pin_memory = device.type == "cuda"
+    obs_cpu = torch.zeros((args.num_envs,) + envs.single_observation_space.shape, pin_memory=pin_memory)
+    reward_cpu = torch.zeros(args.num_envs, pin_memory=pin_memory)
+    done_cpu = torch.zeros(args.num_envs, pin_memory=pin_memory)
+    mask_cpu = torch.zeros((args.num_envs, envs.single_action_space.n), dtype=torch.bool, pin_memory=pin_memory)
+    action_cpu = torch.zeros((args.num_envs,) + envs.single_action_space.shape, dtype=torch.long, pin_memory=pin_memory)
 
     # TRY NOT TO MODIFY: start the game
     global_step = 0
     start_time = time.time()
     next_obs, next_info = envs.reset()
-    next_obs = torch.tensor(next_obs).to(device)
-    next_done = torch.zeros(args.num_envs).to(device)
-    next_masks = torch.from_numpy(next_info["action_mask"]).to(device)
+    obs_cpu.copy_(torch.as_tensor(next_obs))
+    next_obs = obs_cpu.to(device, non_blocking=True)
+    next_done = torch.zeros(args.num_envs, device=device)
+    mask_cpu.copy_(torch.from_numpy(next_info["action_mask"]))
+    next_masks = mask_cpu.to(device, non_blocking=True)
     next_lstm_state = (
         torch.zeros(agent.lstm.num_layers, args.num_envs, agent.lstm.hidden_size).to(device),
         torch.zeros(agent.lstm.num_layers, args.num_envs, agent.lstm.hidden_size).to(device),
@@ -186,18 +204,23 @@ if __name__ == "__main__":
             logprobs[step] = logprob
 
             # TRY NOT TO MODIFY: execute the game and log data.
-            next_obs, reward, done, truncated, info = envs.step(action.cpu().numpy())
-            next_masks = torch.from_numpy(info["action_mask"]).to(device)
-            rewards[step] = torch.tensor(reward).to(device).view(-1)
-            next_obs, next_done = torch.Tensor(next_obs).to(device), torch.Tensor(done).to(device)
-
-            if "episode" in info:  # todo not sure if it's faster than just iterationg over _episode
-                for i in range(args.num_envs):
-                    if info["_episode"][i]:
-                        # print(f"global_step={global_step}, episodic_return={info['episode']['r'][i]}")
-                        writer.add_scalar("charts/episodic_return", info["episode"]["r"][i], global_step)
-                        writer.add_scalar("charts/episodic_length", info["episode"]["l"][i], global_step)
-                        writer.add_scalar("charts/episodic_wins", info["episode"]["w"][i], global_step)
+            # the blocking copy synchronises with the device, so the previous copies out of the staging buffers are done
+            action_cpu.copy_(action)
+            next_obs, reward, done, truncated, info = envs.step(action_cpu.numpy())
+            obs_cpu.copy_(torch.as_tensor(next_obs))
+            mask_cpu.copy_(torch.from_numpy(info["action_mask"]))
+            next_masks.copy_(mask_cpu, non_blocking=True)
+            reward_cpu.copy_(torch.as_tensor(reward))
+            done_cpu.copy_(torch.as_tensor(done))
+            rewards[step].copy_(reward_cpu, non_blocking=True)
+            next_obs, next_done = obs_cpu.to(device, non_blocking=True), done_cpu.to(device, non_blocking=True)
+
+            if "episode" in info:
+                # a single point per metric and step, averaged over the envs that finished an episode
+                finished = info["_episode"]
+                writer.add_scalar("charts/episodic_return", info["episode"]["r"][finished].mean(), global_step)
+                writer.add_scalar("charts/episodic_length", info["episode"]["l"][finished].mean(), global_step)
+                writer.add_scalar("charts/episodic_wins", np.asarray(info["episode"]["w"])[finished].mean(), global_step)
 
         # bootstrap value if not done
         with torch.no_grad():
@@ -205,18 +228,8 @@ if __name__ == "__main__":
                 next_obs,
                 next_lstm_state,
                 next_done,
-            ).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(device)
-            lastgaelam = 0
-            for t in reversed(range(args.num_steps)):
-                if t == args.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
+            ).flatten()
+            advantages = compute_gae(rewards, values, dones, next_value, next_done, args.gamma, args.gae_lambda)
             returns = advantages + values
 
         # flatten the batch
@@ -232,58 +245,27 @@ if __name__ == "__main__":
         # Optimizing the policy and value network
         assert args.num_envs % args.num_minibatches == 0
         envsperbatch = args.num_envs // args.num_minibatches
-        envinds = np.arange(args.num_envs)
-        flatinds = np.arange(args.batch_size).reshape(args.num_steps, args.num_envs)
+        flatinds = torch.arange(args.batch_size, device=device).reshape(args.num_steps, args.num_envs)
         clipfracs = []
         for epoch in range(args.update_epochs):
-            np.random.shuffle(envinds)
+            envinds = torch.randperm(args.num_envs, device=device)
             for start in range(0, args.num_envs, envsperbatch):
                 end = start + envsperbatch
                 mbenvinds = envinds[start:end]
                 mb_inds = flatinds[:, mbenvinds].ravel()  # be really careful about the index
 
                 _, newlogprob, entropy, newvalue, _ = agent.get_action_and_value(
-                    b_obs[mb_inds],
+                    b_obs[mb_inds].float(),
                     (initial_lstm_state[0][:, mbenvinds], initial_lstm_state[1][:, mbenvinds]),
-                    b_dones[mb_inds],
-                    b_actions.long()[mb_inds],
+                    b_dones[mb_inds].float(),
+                    b_actions[mb_inds],
                     mask=b_masks[mb_inds]
                 )
-                logratio = newlogprob - b_logprobs[mb_inds]
-                ratio = logratio.exp()
-
-                with torch.no_grad():
-                    # calculate approx_kl http://joschu.net/blog/kl-approx.html
-                    old_approx_kl = (-logratio).mean()
-                    approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs += [((ratio - 1.0).abs() > args.clip_coef).float().mean().item()]
-
-                mb_advantages = b_advantages[mb_inds]
-                if args.norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
-
-                # Policy loss
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-
-                # Value loss
-                newvalue = newvalue.view(-1)
-                if args.clip_vloss:
-                    v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
-                    v_clipped = b_values[mb_inds] + torch.clamp(
-                        newvalue - b_values[mb_inds],
-                        -args.clip_coef,
-                        args.clip_coef,
-                    )
-                    v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 * ((newvalue - b_returns[mb_inds]) ** 2).mean()
-
-                entropy_loss = entropy.mean()
-                loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
+                loss, pg_loss, v_loss, entropy_loss, old_approx_kl, approx_kl, clipfrac = ppo_loss(
+                    newlogprob, b_logprobs[mb_inds], b_advantages[mb_inds], b_returns[mb_inds], b_values[mb_inds].float(),
+                    newvalue, entropy, args.clip_coef, args.ent_coef, args.vf_coef, args.norm_adv, args.clip_vloss
+                )
+                clipfracs += [clipfrac]
 
                 optimizer.zero_grad()
                 loss.backward()
@@ -294,7 +276,7 @@ if __name__ == "__main__":
                 if approx_kl > args.target_kl:
                     break
 
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
+        y_pred, y_true = b_values.float().cpu().numpy(), b_returns.cpu().numpy()
         var_y = np.var(y_true)
         explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
 
@@ -305,7 +287,7 @@ if __name__ == "__main__":
         writer.add_scalar("losses/entropy", entropy_loss.item(), global_step)
         writer.add_scalar("losses/old_approx_kl", old_approx_kl.item(), global_step)
         writer.add_scalar("losses/approx_kl", approx_kl.item(), global_step)
-        writer.add_scalar("losses/clipfrac", np.mean(clipfracs), global_step)
+        writer.add_scalar("losses/clipfrac", torch.stack(clipfracs).mean().item(), global_step)
         writer.add_scalar("losses/explained_variance", explained_var, global_step)
         # print("SPS:", int(global_step / (time.time() - start_time)))
         writer.add_scalar("charts/SPS", int(global_step / (time.time() - start_time)), global_step)
@@ -1,11 +1,12 @@
 # docs and experiment results can be found at https://docs.cleanrl.dev/rl-algorithms/ppo/#ppopy
 import argparse
 import os
+import queue
 import random
+import threading
 import time
 from distutils.util import strtobool
 
-import gymnasium as gym
 import numpy as np
 import torch
 import torch.nn as nn
@@ -14,8 +15,9 @@ import torch.optim as optim
 from torch.utils.tensorboard import SummaryWriter
 
 from utils.wrappers import MergeActionMaskWrapper, RecordEpisodeStatistics
-from pytag.utils.common import make_env
+from pytag.utils.common import make_vec_env
 from utils.networks import PPONet
+from utils.ppo_utils import compute_gae, ppo_loss
 
 def parse_args():
     # fmt: off
@@ -32,6 +34,8 @@ def parse_args():
         help="if toggled, `torch.backends.cudnn.deterministic=False`")
     parser.add_argument("--cuda", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
         help="if toggled, cuda will be enabled by default")
+    parser.add_argument("--compile", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the policy and value forward passes are compiled with torch.compile (not with --async-rollout)")
     parser.add_argument("--track", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
         help="if toggled, this experiment will be tracked with Weights and Biases")
     parser.add_argument("--wandb-project-name", type=str, default="cleanRL",
@@ -50,8 +54,20 @@ def parse_args():
         help="the learning rate of the optimizer")
     parser.add_argument("--num-envs", type=int, default=2,
         help="the number of parallel game environments")
+    parser.add_argument("--async-envs", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
+        help="if toggled, the game environments are stepped in parallel worker processes when there are more than --sync-threshold of them")
+    parser.add_argument("--sync-threshold", type=int, default=2,
+        help="with at most this many game environments they are stepped in this process even with --async-envs, "
+             "a worker process and JVM per env costs more than it saves for so few (set to 0 to always use workers)")
+    parser.add_argument("--thread-envs", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, the game environments are stepped concurrently by threads of this process (overrides --async-envs)")
+    parser.add_argument("--async-rollout", type=lambda x: bool(strtobool(x)), default=False, nargs="?", const=True,
+        help="if toggled, rollouts are collected in a background thread (on its own CUDA stream on GPU) while the previous one is used for the update")
     parser.add_argument("--num-steps", type=int, default=128,
         help="the number of steps to run in each environment per policy rollout")
+    parser.add_argument("--storage-dtype", type=str, choices=["float32", "float16", "bfloat16"], default="float32",
+        help="the dtype of the reward, done and value rollout storage, it is upcast to float32 on read "
+             "(observations stay float32, the update recomputes the log-probs from them and rounded observations would move the PPO ratio away from 1)")
     parser.add_argument("--anneal-lr", type=lambda x: bool(strtobool(x)), default=True, nargs="?", const=True,
         help="Toggle learning rate annealing for policy and value networks")
     parser.add_argument("--gamma", type=float, default=0.99,
@@ -82,6 +98,9 @@ def parse_args():
         help="the number of players in the env (note some games only support certain number of players)")
     parser.add_argument("--framestack", type=int, default=1)
     args = parser.parse_args()
+    if args.compile and args.async_rollout:
+        # the compiled forward passes (CUDA graphs with reduce-overhead) must not be driven from two threads at once
+        parser.error("--compile cannot be used together with --async-rollout")
     args.batch_size = int(args.num_envs * args.num_steps)
     args.minibatch_size = int(args.batch_size // args.num_minibatches)
     # fmt: on
@@ -126,9 +145,7 @@ if __name__ == "__main__":
         device = torch.device('cpu')
 
     # env setup
-    envs = gym.vector.SyncVectorEnv(
-        [make_env(args.env_id, args.seed + i, args.opponent, args.n_players, framestack=args.framestack) for i in range(args.num_envs)]
-    )
+    envs = make_vec_env(args.env_id, [args.seed + i for i in range(args.num_envs)], args.opponent, args.n_players, args.num_envs, framestack=args.framestack, asynchronous=args.async_envs, sync_threshold=args.sync_threshold, threads=args.thread_envs)
     # envs = SyncVectorEnv([
     #     lambda: StrategoWrapper(gym.make(args.env_id))
     #     for i in range(args.num_envs)
@@ -141,80 +158,156 @@ if __name__ == "__main__":
     # agent = Agent(args, envs).to(device)
     agent = PPONet(args, envs).to(device)
     optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
+    # the policy used to collect rollouts, with --async-rollout this is a copy of the agent that gets synced after each update
+    actor = agent
+    if args.async_rollout:
+        actor = PPONet(args, envs).to(device)
+        actor.load_state_dict(agent.state_dict())
+    actor_lock = threading.Lock()
+    if args.compile:
+        # PPONet has no forward, so the methods called by the rollout and the update are compiled individually
+        # dynamic shapes avoid a recompile for every distinct batch size
+        compile_mode = "reduce-overhead" if device.type == "cuda" else "default"
+        for net in ([agent] if actor is agent else [agent, actor]):
+            net.get_action_and_value = torch.compile(net.get_action_and_value, mode=compile_mode, dynamic=True)
+            net.get_value = torch.compile(net.get_value, mode=compile_mode, dynamic=True)
 
     # ALGO Logic: Storage setup
-    if args.framestack > 1:
-        obs = torch.zeros((args.num_steps, args.num_envs) + (np.array(envs.single_observation_space.shape).prod(),)).to(device)
-    else:
-        obs = torch.zeros((args.num_steps, args.num_envs) + envs.single_observation_space.shape).to(device)
-    masks = torch.zeros((args.num_steps, args.num_envs, envs.single_action_space.n), dtype=torch.bool).to(device)
-    actions = torch.zeros((args.num_steps, args.num_envs) + envs.single_action_space.shape).to(device)
-    logprobs = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    rewards = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    dones = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    values = torch.zeros((args.num_steps, args.num_envs)).to(device)
+    storage_dtype = getattr(torch, args.storage_dtype)
+    def make_storage():
+        if args.framestack > 1:
+            obs = torch.zeros((args.num_steps, args.num_envs) + (np.array(envs.single_observation_space.shape).prod(),), device=device)
+        else:
+            obs = torch.zeros((args.num_steps, args.num_envs) + envs.single_observation_space.shape, device=device)
+        masks = torch.zeros((args.num_steps, args.num_envs, envs.single_action_space.n), dtype=torch.bool, device=device)
+        actions = torch.zeros((args.num_steps, args.num_envs) + envs.single_action_space.shape, dtype=torch.long, device=device)
+        logprobs = torch.zeros((args.num_steps, args.num_envs), device=device)
+        rewards = torch.zeros((args.num_steps, args.num_envs), dtype=storage_dtype, device=device)
+        dones = torch.zeros((args.num_steps, args.num_envs), dtype=storage_dtype, device=device)
+        values = torch.zeros((args.num_steps, args.num_envs), dtype=storage_dtype, device=device)
+        return obs, masks, actions, logprobs, rewards, dones, values
+    # with --async-rollout the next rollout is collected into a second set of buffers while the update reads the first
+    free_storage = queue.Queue()
+    for _ in range(2 if args.async_rollout else 1):
+        free_storage.put(make_storage())
+    # host side staging buffers for the env outputs, pinned on GPU runs so the copies to the device are asynchronous
+    pin_memory = device.type == "cuda"
+    obs_cpu = torch.zeros((args.num_envs,) + envs.single_observation_space.shape, pin_memory=pin_memory)
+    reward_cpu = torch.zeros(args.num_envs, pin_memory=pin_memory)
+    done_cpu = torch.zeros(args.num_envs, pin_memory=pin_memory)
+    mask_cpu = torch.zeros((args.num_envs, envs.single_action_space.n), dtype=torch.bool, pin_memory=pin_memory)
+    action_cpu = torch.zeros((args.num_envs,) + envs.single_action_space.shape, dtype=torch.long, pin_memory=pin_memory)
+
+    # on GPU the background rollout issues its work on its own stream, so that its blocking action copies
+    # only wait for the rollout's kernels and not for the update queued on the default stream
+    rollout_stream = torch.cuda.Stream(device) if args.async_rollout and device.type == "cuda" else None
 
     # TRY NOT TO MODIFY: start the game
     global_step = 0
     start_time = time.time()
     next_obs, next_info = envs.reset()
-    next_obs = torch.tensor(next_obs).to(device)
-    if args.framestack > 1:
-        next_obs = next_obs.view(next_obs.shape[0], -1)
-    next_masks = torch.from_numpy(next_info["action_mask"]).to(device)
-    next_done = torch.zeros(args.num_envs).to(device)
+    obs_cpu.copy_(torch.as_tensor(next_obs))
+    # the rollout state lives on the rollout stream (a no-op without one)
+    with torch.cuda.stream(rollout_stream):
+        next_obs = obs_cpu.to(device, non_blocking=True)
+        if args.framestack > 1:
+            next_obs = next_obs.view(next_obs.shape[0], -1)
+        mask_cpu.copy_(torch.from_numpy(next_info["action_mask"]))
+        next_masks = mask_cpu.to(device, non_blocking=True)
+        next_done = torch.zeros(args.num_envs, device=device)
     num_updates = args.total_timesteps // args.batch_size
 
-    for update in range(1, num_updates + 1):
-        # Annealing the rate if instructed to do so.
-        if args.anneal_lr:
-            frac = 1.0 - (update - 1.0) / num_updates
-            lrnow = frac * args.learning_rate
-            optimizer.param_groups[0]["lr"] = lrnow
-
+    def collect_rollout():
+        # steps all envs for num_steps with the actor and returns the filled storage with the bootstrap data
+        global global_step, next_obs, next_done
+        storage = free_storage.get()
+        obs, masks, actions, logprobs, rewards, dones, values = storage
         for step in range(0, args.num_steps):
             global_step += 1 * args.num_envs
             obs[step] = next_obs
             dones[step] = next_done
 
             # ALGO LOGIC: action logic
-            with torch.no_grad():
-                action, logprob, _, value = agent.get_action_and_value(next_obs, mask=next_masks)
+            with torch.no_grad(), actor_lock:
+                action, logprob, _, value = actor.get_action_and_value(next_obs, mask=next_masks)
                 values[step] = value.flatten()
             actions[step] = action
             masks[step] = next_masks
             logprobs[step] = logprob
 
             # TRY NOT TO MODIFY: execute the game and log data.
-            next_obs, reward, done, truncated, info = envs.step(action.cpu().numpy())
-            next_masks = torch.from_numpy(info["action_mask"]).to(device)
-            rewards[step] = torch.tensor(reward).to(device).view(-1)
-            next_obs, next_done = torch.Tensor(next_obs).to(device), torch.Tensor(done).to(device)
+            # the blocking copy synchronises with the device, so the previous copies out of the staging buffers are done
+            action_cpu.copy_(action)
+            next_obs, reward, done, truncated, info = envs.step(action_cpu.numpy())
+            obs_cpu.copy_(torch.as_tensor(next_obs))
+            mask_cpu.copy_(torch.from_numpy(info["action_mask"]))
+            next_masks.copy_(mask_cpu, non_blocking=True)
+            reward_cpu.copy_(torch.as_tensor(reward))
+            done_cpu.copy_(torch.as_tensor(done))
+            rewards[step].copy_(reward_cpu, non_blocking=True)
+            next_obs, next_done = obs_cpu.to(device, non_blocking=True), done_cpu.to(device, non_blocking=True)
             if args.framestack > 1:
                 next_obs = next_obs.view(next_obs.shape[0], -1)
 
-            if "episode" in info: # todo not sure if it's faster than just iterationg over _episode
-                for i in range(args.num_envs):
-                    if info["_episode"][i]:
-                        # print(f"global_step={global_step}, episodic_return={info['episode']['r'][i]}")
-                        writer.add_scalar("charts/episodic_return", info["episode"]["r"][i], global_step)
-                        writer.add_scalar("charts/episodic_length", info["episode"]["l"][i], global_step)
-                        writer.add_scalar("charts/episodic_wins", info["episode"]["w"][i], global_step)
+            if "episode" in info:
+                # a single point per metric and step, averaged over the envs that finished an episode
+                finished = info["_episode"]
+                writer.add_scalar("charts/episodic_return", info["episode"]["r"][finished].mean(), global_step)
+                writer.add_scalar("charts/episodic_length", info["episode"]["l"][finished].mean(), global_step)
+                writer.add_scalar("charts/episodic_wins", np.asarray(info["episode"]["w"])[finished].mean(), global_step)
 
         # bootstrap value if not done
+        with torch.no_grad(), actor_lock:
+            next_value = actor.get_value(next_obs).flatten()
+        # next_done may alias the staging buffer, which the next rollout overwrites
+        return storage, next_value, next_done.clone(), global_step
+
+    if args.async_rollout:
+        # collect rollouts in a background thread while the main thread runs the PPO updates
+        # the env steps and the torch kernels release the GIL, so the two overlap
+        full_storage = queue.Queue()
+        def rollout_worker():
+            try:
+                for _ in range(num_updates):
+                    with torch.cuda.stream(rollout_stream):
+                        rollout = collect_rollout()
+                    rollout_done = None
+                    if rollout_stream is not None:
+                        # marks the end of this rollout's kernels, the update waits on it before reading the storage
+                        rollout_done = torch.cuda.Event()
+                        rollout_done.record(rollout_stream)
+                    full_storage.put((rollout, rollout_done))
+            except Exception as e:
+                full_storage.put(e)
+        if rollout_stream is not None:
+            # the storage and the actor weights were initialised on the default stream
+            rollout_stream.wait_stream(torch.cuda.current_stream())
+        threading.Thread(target=rollout_worker, daemon=True).start()
+
+    for update in range(1, num_updates + 1):
+        # Annealing the rate if instructed to do so.
+        if args.anneal_lr:
+            frac = 1.0 - (update - 1.0) / num_updates
+            lrnow = frac * args.learning_rate
+            optimizer.param_groups[0]["lr"] = lrnow
+
+        if args.async_rollout:
+            rollout = full_storage.get()
+            if isinstance(rollout, Exception):
+                raise rollout
+            rollout, rollout_done = rollout
+            if rollout_done is not None:
+                torch.cuda.current_stream().wait_event(rollout_done)
+                # allocated on the rollout stream, keep their memory from being reused there while the update reads it
+                rollout[1].record_stream(torch.cuda.current_stream())
+                rollout[2].record_stream(torch.cuda.current_stream())
+        else:
+            rollout = collect_rollout()
+        storage, next_value, next_done_, rollout_step = rollout
+        obs, masks, actions, logprobs, rewards, dones, values = storage
+
         with torch.no_grad():
-            next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(device)
-            lastgaelam = 0
-            for t in reversed(range(args.num_steps)):
-                if t == args.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
+            advantages = compute_gae(rewards, values, dones, next_value, next_done_, args.gamma, args.gae_lambda)
             returns = advantages + values
 
         # flatten the batch
@@ -230,50 +323,19 @@ if __name__ == "__main__":
         b_values = values.reshape(-1)
 
         # Optimizing the policy and value network
-        b_inds = np.arange(args.batch_size)
         clipfracs = []
         for epoch in range(args.update_epochs):
-            np.random.shuffle(b_inds)
+            b_inds = torch.randperm(args.batch_size, device=device)
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 mb_inds = b_inds[start:end]
 
-                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds], b_actions.long()[mb_inds], mask=b_masks[mb_inds])
-                logratio = newlogprob - b_logprobs[mb_inds]
-                ratio = logratio.exp()
-
-                with torch.no_grad():
-                    # calculate approx_kl http://joschu.net/blog/kl-approx.html
-                    old_approx_kl = (-logratio).mean()
-                    approx_kl = ((ratio - 1) - logratio).mean()
-                    clipfracs += [((ratio - 1.0).abs() > args.clip_coef).float().mean().item()]
-
-                mb_advantages = b_advantages[mb_inds]
-                if args.norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
-
-                # Policy loss
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(ratio, 1 - args.clip_coef, 1 + args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-
-                # Value loss
-                newvalue = newvalue.view(-1)
-                if args.clip_vloss:
-                    v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
-                    v_clipped = b_values[mb_inds] + torch.clamp(
-                        newvalue - b_values[mb_inds],
-                        -args.clip_coef,
-                        args.clip_coef,
-                    )
-                    v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 * ((newvalue - b_returns[mb_inds]) ** 2).mean()
-
-                entropy_loss = entropy.mean()
-                loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
+                _, newlogprob, entropy, newvalue = agent.get_action_and_value(b_obs[mb_inds].float(), b_actions[mb_inds], mask=b_masks[mb_inds])
+                loss, pg_loss, v_loss, entropy_loss, old_approx_kl, approx_kl, clipfrac = ppo_loss(
+                    newlogprob, b_logprobs[mb_inds], b_advantages[mb_inds], b_returns[mb_inds], b_values[mb_inds].float(),
+                    newvalue, entropy, args.clip_coef, args.ent_coef, args.vf_coef, args.norm_adv, args.clip_vloss
+                )
+                clipfracs += [clipfrac]
 
                 optimizer.zero_grad()
                 loss.backward()
@@ -284,22 +346,35 @@ if __name__ == "__main__":
                 if approx_kl > args.target_kl:
                     break
 
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
+        y_pred, y_true = b_values.float().cpu().numpy(), b_returns.cpu().numpy()
         var_y = np.var(y_true)
         explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
 
+        # publish the updated weights to the actor before handing the buffers back, the rollout thread waits on
+        # free_storage, so the next rollout it starts already uses these weights (at most one update behind)
+        if args.async_rollout:
+            with actor_lock:
+                # the weights must not change under a forward pass still queued on the rollout stream,
+                # and the rollout stream must not read them or refill the storage before the update is done with it
+                if rollout_stream is not None:
+                    torch.cuda.current_stream().wait_stream(rollout_stream)
+                actor.load_state_dict(agent.state_dict())
+                if rollout_stream is not None:
+                    rollout_stream.wait_stream(torch.cuda.current_stream())
+        free_storage.put(storage)
+
         # TRY NOT TO MODIFY: record rewards for plotting purposes
 
-        writer.add_scalar("charts/learning_rate", optimizer.param_groups[0]["lr"], global_step)
-        writer.add_scalar("losses/value_loss", v_loss.item(), global_step)
-        writer.add_scalar("losses/policy_loss", pg_loss.item(), global_step)
-        writer.add_scalar("losses/entropy", entropy_loss.item(), global_step)
-        writer.add_scalar("losses/old_approx_kl", old_approx_kl.item(), global_step)
-        writer.add_scalar("losses/approx_kl", approx_kl.item(), global_step)
-        writer.add_scalar("losses/clipfrac", np.mean(clipfracs), global_step)
-        writer.add_scalar("losses/explained_variance", explained_var, global_step)
-        # print("SPS:", int(global_step / (time.time() - start_time)))
-        writer.add_scalar("charts/SPS", int(global_step / (time.time() - start_time)), global_step)
+        writer.add_scalar("charts/learning_rate", optimizer.param_groups[0]["lr"], rollout_step)
+        writer.add_scalar("losses/value_loss", v_loss.item(), rollout_step)
+        writer.add_scalar("losses/policy_loss", pg_loss.item(), rollout_step)
+        writer.add_scalar("losses/entropy", entropy_loss.item(), rollout_step)
+        writer.add_scalar("losses/old_approx_kl", old_approx_kl.item(), rollout_step)
+        writer.add_scalar("losses/approx_kl", approx_kl.item(), rollout_step)
+        writer.add_scalar("losses/clipfrac", torch.stack(clipfracs).mean().item(), rollout_step)
+        writer.add_scalar("losses/explained_variance", explained_var, rollout_step)
+        # print("SPS:", int(rollout_step / (time.time() - start_time)))
+        writer.add_scalar("charts/SPS", int(rollout_step / (time.time() - start_time)), rollout_step)
 
     # create checkpoint
     torch.save(agent.state_dict(), f"{results_dir}/agent.pt")
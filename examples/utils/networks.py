@@ -3,7 +3,9 @@ import torch
 from torch import nn
 from torch.distributions import Categorical
 
-def layer_init(layer, std=np.sqrt(2), bias_const=0.0):
+_SQRT2 = 1.4142135623730951  # default gain for layer_init, a plain float rather than a numpy scalar
+
+def layer_init(layer, std=_SQRT2, bias_const=0.0):
     torch.nn.init.orthogonal_(layer.weight, std)
     torch.nn.init.constant_(layer.bias, bias_const)
     return layer
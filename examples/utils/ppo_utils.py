@@ -0,0 +1,71 @@
+# scripted helpers shared by the PPO examples
+from typing import Tuple
+
+import torch
+from torch import Tensor
+
+
+@torch.jit.script
+def compute_gae(rewards: Tensor, values: Tensor, dones: Tensor, next_value: Tensor, next_done: Tensor,
+                gamma: float, gae_lambda: float) -> Tensor:
+    # generalised advantage estimation over a [num_steps, num_envs] rollout
+    # scripted so the per step pointwise ops are fused and run without the python interpreter
+    # the rollout storage may be kept in lower precision, each step is upcast to float32 as it is read
+    num_steps = rewards.shape[0]
+    advantages = torch.zeros_like(rewards, dtype=torch.float32)
+    lastgaelam = torch.zeros_like(next_value, dtype=torch.float32)
+    for t in range(num_steps - 1, -1, -1):
+        if t == num_steps - 1:
+            nextnonterminal = 1.0 - next_done.float()
+            nextvalues = next_value.float()
+        else:
+            nextnonterminal = 1.0 - dones[t + 1].float()
+            nextvalues = values[t + 1].float()
+        delta = rewards[t].float() + gamma * nextvalues * nextnonterminal - values[t].float()
+        lastgaelam = delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+        advantages[t] = lastgaelam
+    return advantages
+
+
+@torch.jit.script
+def pg_loss_fn(advantages: Tensor, ratio: Tensor, clip_coef: float, norm_adv: bool) -> Tensor:
+    # clipped surrogate policy loss, the advantage normalisation and the clipping fuse into one pointwise kernel
+    if norm_adv:
+        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
+    pg_loss1 = -advantages * ratio
+    pg_loss2 = -advantages * torch.clamp(ratio, 1 - clip_coef, 1 + clip_coef)
+    return torch.maximum(pg_loss1, pg_loss2).mean()
+
+
+@torch.jit.script
+def ppo_loss(newlogprob: Tensor, logprobs: Tensor, advantages: Tensor, returns: Tensor, values: Tensor,
+             newvalue: Tensor, entropy: Tensor, clip_coef: float, ent_coef: float, vf_coef: float,
+             norm_adv: bool, clip_vloss: bool) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor]:
+    # clipped PPO objective for one minibatch, scripted so the pointwise ops are fused into fewer kernels
+    # returns (loss, pg_loss, v_loss, entropy_loss, old_approx_kl, approx_kl, clipfrac)
+    logratio = newlogprob - logprobs
+    ratio = logratio.exp()
+
+    # calculate approx_kl http://joschu.net/blog/kl-approx.html
+    logratio_ = logratio.detach()
+    ratio_ = ratio.detach()
+    old_approx_kl = (-logratio_).mean()
+    approx_kl = ((ratio_ - 1) - logratio_).mean()
+    clipfrac = ((ratio_ - 1.0).abs() > clip_coef).float().mean()
+
+    # Policy loss
+    pg_loss = pg_loss_fn(advantages, ratio, clip_coef, norm_adv)
+
+    # Value loss
+    newvalue = newvalue.view(-1)
+    if clip_vloss:
+        v_loss_unclipped = (newvalue - returns) ** 2
+        v_clipped = values + torch.clamp(newvalue - values, -clip_coef, clip_coef)
+        v_loss_clipped = (v_clipped - returns) ** 2
+        v_loss = 0.5 * torch.max(v_loss_unclipped, v_loss_clipped).mean()
+    else:
+        v_loss = 0.5 * ((newvalue - returns) ** 2).mean()
+
+    entropy_loss = entropy.mean()
+    loss = pg_loss - ent_coef * entropy_loss + v_loss * vf_coef
+    return loss, pg_loss, v_loss, entropy_loss, old_approx_kl, approx_kl, clipfrac
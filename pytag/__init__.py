@@ -1,3 +1,11 @@
-from pytag.pyTAG import PyTAG, MultiAgentPyTAG, list_supported_games
+# the core classes are imported on first access, so that importing pytag (or pytag.utils / pytag.gym_wrapper)
+# does not pull in jpype until a game is actually needed
+__all__ = ["PyTAG", "MultiAgentPyTAG", "list_supported_games"]
 
-__all__ = ["PyTAG", "MultiAgentPyTAG", "list_supported_games"]
\ No newline at end of file
+def __getattr__(name):
+    if name in __all__:
+        from pytag import pyTAG
+        value = getattr(pyTAG, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -6,26 +6,36 @@ import jpype.imports
 
 import numpy as np
 from typing import List
-def list_supported_games(as_json=False):
-    tag_jar = os.path.join(os.path.dirname(__file__), 'jars', 'ModernBoardGame.jar')
-    jpype.addClassPath(tag_jar)
+
+def _ensure_jvm():
+    # the JVM is started on first use rather than on import, so that processes forked or spawned
+    # before any game is created (e.g.: vector env workers) each start their own
     if not jpype.isJVMStarted():
+        tag_jar = os.path.join(os.path.dirname(__file__), 'jars', 'ModernBoardGame.jar')
+        jpype.addClassPath(tag_jar)
         jpype.startJVM(convertStrings=False)
+
+def list_supported_games(as_json=False):
+    _ensure_jvm()
     PyTAGEnv = jpype.JClass("core.PyTAG")
     if as_json:
         return json.loads(str(PyTAGEnv.getSupportedGamesJSON()))
     return PyTAGEnv.getSupportedGames()
 
+_AGENT_SPECS = {"random": "players.simple.RandomPlayer", "mcts": "players.mcts.MCTSPlayer",
+                "osla": "players.simple.OSLAPlayer", "python": "players.python.PythonAgent"}
+# java classes are only resolved once per agent type
+_AGENT_CLASSES = {}
+# integer code of each agent type, so the roles of the players can be kept in a small array
+_AGENT_ID_MAP = {"python": 0, "random": 1, "mcts": 2, "osla": 3}
+
 def get_agent_class(agent_name):
-    if agent_name == "random":
-        return jpype.JClass("players.simple.RandomPlayer")
-    if agent_name == "mcts":
-        return jpype.JClass("players.mcts.MCTSPlayer")
-    if agent_name == "osla":
-        return jpype.JClass("players.simple.OSLAPlayer")
-    if agent_name == "python":
-        return jpype.JClass("players.python.PythonAgent")
-    return None
+    if agent_name not in _AGENT_SPECS:
+        return None
+    if agent_name not in _AGENT_CLASSES:
+        _ensure_jvm()
+        _AGENT_CLASSES[agent_name] = jpype.JClass(_AGENT_SPECS[agent_name])
+    return _AGENT_CLASSES[agent_name]
 
 def get_mcts_with_params(json_path):
     PlayerFactory = jpype.JClass("players.PlayerFactory")
@@ -34,8 +44,14 @@ def get_mcts_with_params(json_path):
     json_string = str(json_string).replace('\'', '\"') # JAVA only uses " for string
     return jpype.JClass("players.mcts.MCTSPlayer")(PlayerFactory.fromJSONString(json_string))
 
-# create the game registry when PyTAG is loaded
-_game_registry = list_supported_games(as_json=True)
+# the game registry is loaded together with the JVM when the first game is created
+_game_registry = None
+def _get_game_registry():
+    global _game_registry
+    if _game_registry is None:
+        _game_registry = list_supported_games(as_json=True)
+    return _game_registry
+
 class PyTAG():
     """Core class to interact with the pyTAG environment. This class is a wrapper around the Java environment.
     This class expects to have a single python agents
@@ -47,13 +63,10 @@ class PyTAG():
         self._rnd = random.Random(seed)
         self._obs_type = obs_type
 
-        assert game_id in _game_registry, f"Game {game_id} not supported. Supported games are {_game_registry}"
-        assert _game_registry[game_id][obs_type] == True, f"Game {game_id} does not support observation type {obs_type}"
-        # start up the JVM
-        tag_jar = os.path.join(os.path.dirname(__file__), 'jars', 'ModernBoardGame.jar')
-        jpype.addClassPath(tag_jar)
-        if not jpype.isJVMStarted():
-            jpype.startJVM(convertStrings=False)
+        # start up the JVM if needed and check the game against the registry
+        game_registry = _get_game_registry()
+        assert game_id in game_registry, f"Game {game_id} not supported. Supported games are {game_registry}"
+        assert game_registry[game_id][obs_type] == True, f"Game {game_id} does not support observation type {obs_type}"
 
         # access to the java classes
         PyTAGEnv = jpype.JClass("core.PyTAG")
@@ -68,6 +81,8 @@ class PyTAG():
         else:
             agents = [get_agent_class(agent_id)() for agent_id in agent_ids]
         self._playerID = agent_ids.index("python") # if multiple python agents this is the first one
+        self._agent_id_arr = np.fromiter((_AGENT_ID_MAP[agent_id] for agent_id in agent_ids), dtype=np.int8,
+                                         count=len(agent_ids))
         self._java_env = PyTAGEnv(gameType, None, jpype.java.util.ArrayList(agents), seed, True)
 
         # Construct action/observation space
@@ -176,10 +191,8 @@ class MultiAgentPyTAG(PyTAG):
     """
     def __init__(self, agent_ids: List[str], game_id: str="Diamant", seed: int=0, obs_type:str="vector"):
         super().__init__(agent_ids, game_id, seed, obs_type)
-        self._playerIDs = []
         # collect all the player ids that are python agents
-        for i, agent_id in enumerate(agent_ids):
-            if agent_id == "python": self._playerIDs.append(i)
+        self._playerIDs = np.flatnonzero(self._agent_id_arr == _AGENT_ID_MAP["python"]).tolist()
         self._last_obs_vector = {player_id: None for player_id in self._playerIDs}
         self._last_action_mask = {player_id: None for player_id in self._playerIDs}
 
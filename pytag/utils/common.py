@@ -1,45 +1,133 @@
 # various helper functions
+import multiprocessing
+import os
+import sys
+from contextlib import contextmanager
+from functools import lru_cache
+
 import gymnasium as gym
-from gymnasium.wrappers.frame_stack import FrameStack
 import numpy as np
-import torch
 
-import jpype
-import jpype.imports
-from utils.wrappers import StrategoWrapper, SushiGoWrapper
+# torch and the TAG environments are imported where they are used, so that importing this module stays cheap
+# for the vector env workers and for scripts that only need some of the helpers
+from utils.wrappers import CompositeObsWrapper, ThreadVectorEnv, stratego_obs, sushi_go_obs
 
 
-def make_env(env_id, seed, opponent, n_players, framestack=1, obs_type="vector"):
-    def thunk():
-        # always have a python agent first (at least in our experiments)
-        agent_ids = ["python"]
-        for i in range(n_players - 1):
-            agent_ids.append(opponent)
+# game specific observation transforms and the shape of their output, keyed by a name that appears in the env_id
+_OBS_TRANSFORMS = {
+    "Stratego": (stratego_obs, (27, 10, 10)),
+    "Sushi": (sushi_go_obs, (147,)),
+}
+
+def get_obs_transform(env_id):
+    # returns the observation transform used for env_id and the space of its output, (None, None) if there is none
+    # the first matching game is used, so an env_id can never get two transforms
+    for game, (transform_fn, shape) in _OBS_TRANSFORMS.items():
+        if game in env_id:
+            return transform_fn, gym.spaces.Box(low=0, high=1, shape=shape, dtype=np.float32)
+    return None, None
+
+@lru_cache(maxsize=32)
+def _env_builder(env_id, opponent, n_players, framestack, obs_type):
+    # resolves everything that does not depend on the seed once per configuration (in each process),
+    # so that the envs of a vector env only differ in the call to make
+    from pytag import gym_wrapper  # registers the TAG environments, this runs inside the vector env workers
+    spec = gym.spec(env_id)
+    # always have a python agent first (at least in our experiments)
+    agent_ids = ("python",) + (opponent,) * (n_players - 1)
+    # the game specific transform and the frame stacking are applied by a single wrapper
+    # the observation space is only read by the wrapper, so one instance is shared by all envs of the configuration
+    transform_fn, observation_space = get_obs_transform(env_id)
+    def make(seed):
         # obs_type = "json" if "Sushi" in env_id else "vector" # , obs_type=obs_type
-        env = gym.make(env_id, seed=seed, agent_ids=agent_ids, obs_type=obs_type)
-        if "Stratego" in env_id:
-            env = StrategoWrapper(env)
-        if "Sushi" in env_id:
-            env = SushiGoWrapper(env)
-        if framestack > 1:
-            env = FrameStack(env, framestack)
+        env = gym.make(spec, seed=seed, agent_ids=agent_ids, obs_type=obs_type)
+        if transform_fn is not None or framestack > 1:
+            env = CompositeObsWrapper(env, transform_fn, observation_space, framestack)
+        return env
+    return make
+
+def make_env(env_id, seed, opponent, n_players, framestack=1, obs_type="vector", warmup=True, worker_id=None,
+             pin_cpu=False):
+    # worker_id is only given when the env gets a worker process of its own (see make_vec_env)
+    def thunk():
+        # AsyncVectorEnv also calls the first thunk in the training process to read the spaces,
+        # the worker only setup must not touch that process
+        in_worker = worker_id is not None and multiprocessing.parent_process() is not None
+        if in_worker:
+            # each worker steps a single game, make_vec_env spawns it with OMP/MKL_NUM_THREADS=1 unless these are set,
+            # torch's intra-op pool is capped here as well in case it was sized from other values
+            if "torch" in sys.modules:
+                sys.modules["torch"].set_num_threads(1)
+            if pin_cpu and hasattr(os, "sched_setaffinity"):
+                cpus = sorted(os.sched_getaffinity(0))
+                os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+        env = _env_builder(env_id, opponent, n_players, framestack, obs_type)(seed)
+        # the probe env AsyncVectorEnv builds in the training process is only used to read the spaces, skip its warmup
+        if warmup and (worker_id is None or in_worker):
+            # play one random step before handing the env out, so that the JVM has loaded and compiled the game's
+            # step path before the first timed rollout instead of stalling the first batch on the slowest worker
+            env.reset()
+            env.step(env.unwrapped.sample_rnd_action())
+            env.reset()
         return env
     return thunk
+
+@contextmanager
+def _single_threaded_workers():
+    # processes started inside inherit OMP/MKL_NUM_THREADS=1 (unless already set), so that each vector env worker
+    # sizes its OpenMP/MKL pools for one thread when numpy or torch are first imported there
+    # the environment of this process is restored afterwards
+    saved = {var: os.environ.get(var) for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS")}
+    for var in saved:
+        os.environ.setdefault(var, "1")
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+def make_vec_env(env_id, seeds, opponent, n_players, num_envs, framestack=1, obs_type="vector", asynchronous=True,
+                 sync_threshold=2, threads=False, warmup=True, pin_cpus=False, device=None):
+    # creates num_envs environments with make_env, when asynchronous each game is stepped in its own worker process
+    # with at most sync_threshold envs the pickling and pipe round trip to the workers costs more than a TAG step,
+    # so these are stepped in process, their observations are batched into one preallocated array (copy=False)
+    # with threads the envs stay in this process and are stepped concurrently by a thread pool instead
+    # pin_cpus pins each worker process to a single core, off by default as the JVM also runs its JIT and GC threads there
+    # with a device the observations are returned as a tensor on it, see TorchObsVectorEnv
+    in_process = threads or not (asynchronous and num_envs > sync_threshold)
+    env_fns = [make_env(env_id, seeds[i], opponent, n_players, framestack, obs_type, warmup,
+                        worker_id=None if in_process else i, pin_cpu=pin_cpus) for i in range(num_envs)]
+    if threads:
+        envs = ThreadVectorEnv(env_fns, copy=False)
+    elif not in_process:
+        # the workers write their observations straight into shared memory instead of pickling them through the pipe,
+        # this needs a fixed shape Box, which raw json observations only become after a game specific transform
+        shared_memory = obs_type == "vector" or get_obs_transform(env_id)[0] is not None
+        # the workers are spawned rather than forked, so that each of them starts its own JVM
+        with _single_threaded_workers():
+            envs = gym.vector.AsyncVectorEnv(env_fns, shared_memory=shared_memory, copy=False, context="spawn")
+    else:
+        envs = gym.vector.SyncVectorEnv(env_fns, copy=False)
+    if device is not None:
+        from utils.torch_wrappers import TorchObsVectorEnv
+        envs = TorchObsVectorEnv(envs, device)
+    return envs
+
+def get_agent_class(agent_name):
+    # re-exported from pytag.pyTAG, imported here on first use so that this module does not load jpype
+    from pytag.pyTAG import get_agent_class
+    return get_agent_class(agent_name)
+
 def get_agent_list():
     return ["random", "mcts", "osla", "python"]
 
-def get_agent_class(agent_name):
-    if agent_name == "random":
-        return jpype.JClass("players.simple.RandomPlayer")
-    if agent_name == "mcts":
-        return jpype.JClass("players.mcts.MCTSPlayer")
-    if agent_name == "osla":
-        return jpype.JClass("players.simple.OSLAPlayer")
-    if agent_name == "python":
-        return jpype.JClass("players.python.PythonAgent")
-    return None
-
-def layer_init(layer, std=np.sqrt(2), bias_const=0.0):
+_SQRT2 = 1.4142135623730951  # default gain for layer_init, a plain float rather than a numpy scalar
+
+def layer_init(layer, std=_SQRT2, bias_const=0.0):
+    import torch
     torch.nn.init.orthogonal_(layer.weight, std)
     torch.nn.init.constant_(layer.bias, bias_const)
-    return layer
\ No newline at end of file
+    return layer
@@ -0,0 +1,52 @@
+# vector env wrappers that need torch, kept apart from wrappers.py so that the env workers do not import torch
+import numpy as np
+import torch
+
+from gymnasium.vector import VectorEnvWrapper
+
+
+class TorchObsVectorEnv(VectorEnvWrapper):
+    # Returns the batched observations as a float32 tensor on device and accepts the actions as a tensor.
+    # On cuda the observations of all envs are staged in one pinned host buffer and uploaded with a single
+    # non-blocking copy per step, the actions are moved to the host once for the whole batch.
+    # Rewards, dones and infos (incl. final_observation and the action masks) stay numpy, so the numpy based
+    # wrappers on top (MergeActionMaskWrapper, RecordEpisodeStatistics) keep working.
+    # The observations need a fixed shape Box, i.e. obs_type="vector" or a game specific transform.
+    def __init__(self, env, device):
+        super().__init__(env)
+        self.device = torch.device(device)
+        shape = (env.num_envs,) + env.single_observation_space.shape
+        self._pinned = self.device.type == "cuda"
+        self._obs_cpu = torch.empty(shape, dtype=torch.float32, pin_memory=self._pinned)
+        self._upload_done = None
+
+    def _obs_to_device(self, obs):
+        if self._upload_done is not None:
+            # the previous upload may still be reading the staging buffer
+            self._upload_done.synchronize()
+        self._obs_cpu.copy_(torch.from_numpy(np.asarray(obs)))
+        if not self._pinned:
+            # the vector envs reuse their observation array, so the tensor handed out must not alias it
+            return self._obs_cpu.to(self.device, copy=True)
+        obs = self._obs_cpu.to(self.device, non_blocking=True)
+        self._upload_done = torch.cuda.Event()
+        self._upload_done.record()
+        return obs
+
+    def reset_wait(self, **kwargs):
+        obs, infos = self.env.reset_wait(**kwargs)
+        return self._obs_to_device(obs), infos
+
+    def step_async(self, actions):
+        if isinstance(actions, torch.Tensor):
+            actions = actions.cpu().numpy()
+        return self.env.step_async(actions)
+
+    def step_wait(self):
+        obs, rewards, dones, truncated, infos = self.env.step_wait()
+        return self._obs_to_device(obs), rewards, dones, truncated, infos
+
+    def step_tensor(self, actions):
+        # steps with a tensor of actions and returns the observations on device, same as step
+        # note that this steps this wrapper directly, use step on the outermost wrapper if there are more on top
+        return self.step(actions)
@@ -1,14 +1,16 @@
 import time
 import json
 from collections import deque
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import numpy as np
-import torch
 
 
 import gymnasium as gym
-from gymnasium.vector import VectorEnvWrapper
+from gymnasium.vector import SyncVectorEnv, VectorEnvWrapper
+from gymnasium.vector.utils import concatenate
 
 
 class MergeActionMaskWrapper(VectorEnvWrapper):
@@ -25,6 +27,94 @@ class MergeActionMaskWrapper(VectorEnvWrapper):
         del infos["_action_mask"] # Not needed
         return infos
 
+SUSHI_GO_CARD_TYPES = ["Maki", "Maki-2", "Maki-3", "Chopsticks", "Tempura", "Sashimi", "Dumpling", "SquidNigiri",
+                       "SalmonNigiri", "EggNigiri", "Wasabi", "Pudding"]
+SUSHI_GO_MAX_CARDS_IN_HAND = 10
+_STRATEGO_ONE_HOT = np.eye(27, dtype=np.float32)
+
+# game specific observation transforms, kept as plain functions so CompositeObsWrapper can call them without
+# going through a wrapper's bound methods
+def stratego_obs(observation):
+    # one-hot encodes the 10x10 board, piece ids are in [-13, 13]
+    board = np.asarray(observation).reshape(10, 10).astype(np.int64)
+    return _STRATEGO_ONE_HOT[board + 13].transpose(2, 0, 1)
+
+def sushi_go_card_emb(card):
+    card_emb = np.zeros(len(SUSHI_GO_CARD_TYPES))
+    if card != "EmptyDeck":
+        card_emb[SUSHI_GO_CARD_TYPES.index(card)] = 1
+    return card_emb
+
+def sushi_go_obs(json_obs, normalise=True):
+    # actions represent cardIds from left to right
+    json_ = json.loads(str(json_obs))
+    player_id = json_["PlayerID"]
+    played_cards = json_["playedCards"].split(",")
+    cards_in_hand = json_["cardsInHand"].split(",")
+    score = json_["playerScore"] / 50  # keep it close to 0-1
+    round = json_["rounds"] / 3  # max 3 rounds
+
+    opp_scores = []
+    opponent_played_cards_ = []
+    for key in json_.keys():
+        if f"opp" in key and "playedCards" in key:
+            opp_played_cards = json_[key].split(",")
+            opponent_played_cards_.append(([sushi_go_card_emb(card) for card in opp_played_cards]))
+        if f"opp" in key and "score" in key:
+            opp_score = json_[key] / 50
+            opp_scores.append(opp_score)
+
+    played_cards_ = [sushi_go_card_emb(card) for card in played_cards]
+    cards_in_hand_ = [sushi_go_card_emb(card) for card in cards_in_hand]
+    while len(cards_in_hand_) < SUSHI_GO_MAX_CARDS_IN_HAND:
+        cards_in_hand_.append(np.zeros(len(SUSHI_GO_CARD_TYPES)))
+
+    score = np.expand_dims(score, 0)
+    round = np.expand_dims(round, 0)
+    played_cards = np.sum(played_cards_, axis=0)
+    cards_in_hand = np.stack(cards_in_hand_, 0).flatten()
+    opp_played_cards = np.sum(opponent_played_cards_, axis=1).flatten()
+    obs = np.concatenate([score, round, played_cards, cards_in_hand, opp_played_cards, opp_scores])
+    return obs.astype(np.float32)
+
+class ThreadVectorEnv(SyncVectorEnv):
+    # Like SyncVectorEnv, but the sub-environments are stepped concurrently from a pool of threads.
+    # jpype releases the GIL while a call runs inside the JVM, so the TAG games advance in parallel in one process,
+    # without the pickling and pipe round trips of AsyncVectorEnv.
+    def __init__(self, env_fns, num_threads=None, copy=True, **kwargs):
+        super().__init__(env_fns, copy=copy, **kwargs)
+        self._pool = ThreadPoolExecutor(max_workers=num_threads or self.num_envs)
+
+    @staticmethod
+    def _step_env(env, action):
+        observation, reward, terminated, truncated, info = env.step(action)
+        if terminated or truncated:
+            old_observation, old_info = observation, info
+            observation, info = env.reset()
+            info["final_observation"] = old_observation
+            info["final_info"] = old_info
+        return observation, reward, terminated, truncated, info
+
+    def step_wait(self):
+        observations, infos = [], {}
+        # the results come back in env order, so the infos are merged exactly as in SyncVectorEnv
+        for i, result in enumerate(self._pool.map(self._step_env, self.envs, self._actions)):
+            observation, self._rewards[i], self._terminateds[i], self._truncateds[i], info = result
+            observations.append(observation)
+            infos = self._add_info(infos, info, i)
+        self.observations = concatenate(self.single_observation_space, observations, self.observations)
+        return (
+            deepcopy(self.observations) if self.copy else self.observations,
+            np.copy(self._rewards),
+            np.copy(self._terminateds),
+            np.copy(self._truncateds),
+            infos,
+        )
+
+    def close_extras(self, **kwargs):
+        self._pool.shutdown()
+        super().close_extras(**kwargs)
+
 class StrategoWrapper(gym.ObservationWrapper):
     def __init__(self, env):
         super().__init__(env)
@@ -33,65 +123,71 @@ class StrategoWrapper(gym.ObservationWrapper):
         obs, info = self.env.reset(**kwargs)
         return self.observation(obs), info
     def observation(self, observation):
-        observation_ = torch.from_numpy(observation.reshape(10, 10)).to(torch.int64)
-        observation_ = torch.nn.functional.one_hot(observation_+13, num_classes=27)
-        observation_ = observation_.permute(2, 0, 1).float()
-        return observation_
+        return np.ascontiguousarray(stratego_obs(observation), dtype=np.float32)
 
 class SushiGoWrapper(gym.ObservationWrapper):
     # Sushi GO wrapper - an example that extracts the observation from JSON
     def __init__(self, env):
         super().__init__(env)
-        self.card_types = ["Maki", "Maki-2", "Maki-3", "Chopsticks", "Tempura", "Sashimi", "Dumpling", "SquidNigiri",
-                      "SalmonNigiri", "EggNigiri", "Wasabi", "Pudding"]
+        self.card_types = SUSHI_GO_CARD_TYPES
 
         self.observation_space = gym.spaces.Box(low=0, high=1, shape=[147], dtype=np.float32)
-        self.max_cards_in_hand = 10
+        self.max_cards_in_hand = SUSHI_GO_MAX_CARDS_IN_HAND
     def reset(self, **kwargs):
         obs, info = self.env.reset(**kwargs)
         return self.observation(obs), info
     def observation(self, observation):
-        obs = self.process_json_obs(observation)
-        obs = torch.from_numpy(obs).float()
-        return obs
+        return np.ascontiguousarray(self.process_json_obs(observation), dtype=np.float32)
 
     def get_card_id(self, card):
-        card_emb = np.zeros(len(self.card_types))
-        if card != "EmptyDeck":
-            card_emb[self.card_types.index(card)] = 1
-        return card_emb
+        return sushi_go_card_emb(card)
 
     def process_json_obs(self, json_obs, normalise=True):
-        # actions represent cardIds from left to right
-        json_ = json.loads(str(json_obs))
-        player_id = json_["PlayerID"]
-        played_cards = json_["playedCards"].split(",")
-        cards_in_hand = json_["cardsInHand"].split(",")
-        score = json_["playerScore"] / 50  # keep it close to 0-1
-        round = json_["rounds"] / 3  # max 3 rounds
-
-        opp_scores = []
-        opponent_played_cards_ = []
-        for key in json_.keys():
-            if f"opp" in key and "playedCards" in key:
-                opp_played_cards = json_[key].split(",")
-                opponent_played_cards_.append(([self.get_card_id(card) for card in opp_played_cards]))
-            if f"opp" in key and "score" in key:
-                opp_score = json_[key] / 50
-                opp_scores.append(opp_score)
-
-        played_cards_ = [self.get_card_id(card) for card in played_cards]
-        cards_in_hand_ = [self.get_card_id(card) for card in cards_in_hand]
-        while len(cards_in_hand_) < self.max_cards_in_hand:
-            cards_in_hand_.append(np.zeros(len(self.card_types)))
-
-        score = np.expand_dims(score, 0)
-        round = np.expand_dims(round, 0)
-        played_cards = np.sum(played_cards_, axis=0)
-        cards_in_hand = np.stack(cards_in_hand_, 0).flatten()
-        opp_played_cards = np.sum(opponent_played_cards_, axis=1).flatten()
-        obs = np.concatenate([score, round, played_cards, cards_in_hand, opp_played_cards, opp_scores])
-        return obs
+        return sushi_go_obs(json_obs, normalise)
+
+class CompositeObsWrapper(gym.ObservationWrapper):
+    # Applies a game specific transform and stacks the last framestack observations in a single wrapper,
+    # so that each observation goes through one python frame instead of one per wrapper.
+    # transform_fn maps a raw observation to one matching observation_space, e.g. stratego_obs or sushi_go_obs.
+    # Frames are kept in a preallocated ring buffer and returned in the (framestack, *obs_shape) layout of
+    # gymnasium's FrameStack with the oldest frame first.
+    # Observations are returned as contiguous float32 arrays, so they can be copied to the network as they are.
+    # Note that the stacked array returned by step is reused, copy it if it needs to outlive the next step.
+    def __init__(self, env, transform_fn=None, observation_space=None, framestack=1):
+        super().__init__(env)
+        self._transform = transform_fn
+        space = observation_space if observation_space is not None else self.observation_space
+        if space.dtype != np.float32:
+            space = gym.spaces.Box(low=space.low, high=space.high, shape=space.shape, dtype=np.float32)
+        self.observation_space = space
+        self.framestack = framestack
+        if framestack > 1:
+            low = np.repeat(self.observation_space.low[np.newaxis, ...], framestack, axis=0)
+            high = np.repeat(self.observation_space.high[np.newaxis, ...], framestack, axis=0)
+            self.observation_space = gym.spaces.Box(low=low, high=high, dtype=self.observation_space.dtype)
+            self._buf = np.zeros(self.observation_space.shape, dtype=self.observation_space.dtype)
+            self._out = np.zeros_like(self._buf)
+            self._idx = 0
+            # order to read the ring in for each write position, oldest frame first
+            self._orders = [np.array([(j + i) % framestack for i in range(framestack)]) for j in range(framestack)]
+    def reset(self, **kwargs):
+        obs, info = self.env.reset(**kwargs)
+        if self._transform is not None:
+            obs = self._transform(obs)
+        if self.framestack == 1:
+            return np.ascontiguousarray(obs, dtype=np.float32), info
+        self._buf[:] = obs
+        self._idx = 0
+        # a fresh array so that it does not alias the final observation of the previous episode
+        return self._buf.copy(), info
+    def observation(self, observation):
+        if self._transform is not None:
+            observation = self._transform(observation)
+        if self.framestack == 1:
+            return np.ascontiguousarray(observation, dtype=np.float32)
+        self._buf[self._idx] = observation
+        self._idx = (self._idx + 1) % self.framestack
+        return np.take(self._buf, self._orders[self._idx], axis=0, out=self._out)
 
 class RecordEpisodeStatistics(gym.Wrapper):
     # Based on RecordEpisodeStatistics from gymnasium, but it checks whether the player has won the game